@@ -1,7 +1,7 @@
-from setuptools import setup, find_packages
+from setuptools import setup
 from setuptools.extension import Extension
-from scalene.scalene_version import scalene_version
 from os import path, environ
+import os
 import sys
 import sysconfig
 
@@ -11,31 +11,102 @@ if sys.platform == 'darwin':
     target = environ[mdt] if mdt in environ else sysconfig.get_config_var(mdt)
     # target >= 10.9 is required for gcc/clang to find libstdc++ headers
     if [int(n) for n in target.split('.')] < [10, 9]:
-        from os import execve
-        newenv = environ.copy()
-        newenv[mdt] = '10.9'
-        execve(sys.executable, [sys.executable] + sys.argv, newenv)
+        # Adjust it in-process rather than re-executing setup.py with a new environment;
+        # get_config_vars() returns the cached dictionary, so update that as well.
+        environ[mdt] = '10.9'
+        sysconfig.get_config_vars()[mdt] = '10.9'
 
 
+ARCH_PROBE_CACHE = path.join('build', '.arch_probe_cache.json')
+
+def arch_probe_key(compiler: str, archs):
+    """Returns a key identifying the given compiler and architectures, for caching probe results"""
+    import hashlib
+    import platform
+    import shutil
+
+    def mtime(p):
+        try:
+            return path.getmtime(p)
+        except OSError:
+            return None
+
+    compiler_path = shutil.which(compiler) or compiler
+    # On MacOS, /usr/bin/clang++ is an xcrun shim that stays the same across Xcode/CLT
+    # updates and switches, so also include what selects the actual toolchain and SDKs.
+    key = [compiler_path, mtime(compiler_path), platform.mac_ver()[0], archs,
+           environ.get('DEVELOPER_DIR'), environ.get('SDKROOT'), environ.get('ARCHFLAGS'),
+           mtime('/var/db/xcode_select_link'), mtime('/Library/Developer/CommandLineTools/SDKs')]
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
 def compiler_archs(compiler: str):
     """Discovers what platforms the given supports; intended for MacOS use"""
+    import json
     import tempfile
     import subprocess
     from pathlib import Path
+    from concurrent.futures import ThreadPoolExecutor
 
     print(f"Compiler: {compiler}")
-    arch_flags = []
 
     # see also the architectures tested for in .github/workflows/build-and-upload.yml
-    for arch in ['x86_64', 'arm64', 'arm64e']:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            cpp = Path(tmpdir) / 'test.cxx'; cpp.write_text('int main() {return 0;}\n')
-            out = Path(tmpdir) / 'a.out'
-            p = subprocess.run([compiler, "-arch", arch, str(cpp), "-o", str(out)], capture_output=True)
-            if p.returncode == 0:
-                arch_flags += ['-arch', arch]
+    archs = ['x86_64', 'arm64']
+    # arm64e is rarely supported outside of Apple, so only probe for it if asked to
+    if environ.get('SCALENE_PROBE_ARM64E', '0') != '0':
+        archs.append('arm64e')
+
+    # Probing is slow-ish, so reuse earlier results while the toolchain is unchanged.
+    key = arch_probe_key(compiler, archs)
+    try:
+        with open(ARCH_PROBE_CACHE, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if key in cache:
+        print(f"Cached {compiler} arch flags: {cache[key]} (delete {ARCH_PROBE_CACHE} to re-probe)")
+        return cache[key]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # The test program is written once and shared by all probes.  It can't be fed
+        # through stdin: with several -arch flags, clang runs a compile job per arch,
+        # and only the first of them would get to read it.
+        cpp = Path(tmpdir) / 'test.cxx'; cpp.write_text('int main() {return 0;}\n')
+
+        def probe(archs):
+            out = Path(tmpdir) / ('a.out.' + '-'.join(archs))
+            arch_args = [flag for arch in archs for flag in ['-arch', arch]]
+            p = subprocess.run([compiler] + arch_args + [str(cpp), "-o", str(out)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            return p.returncode == 0
+
+        # clang accepts several -arch flags at once, building a universal binary; trying
+        # that first usually tells us everything with a single compiler invocation.
+        for candidates in ([archs, archs[:2]] if len(archs) > 2 else [archs]):
+            if probe(candidates):
+                supported = candidates
+                break
+        else:
+            # The probes are independent and subprocess-bound, so run them concurrently.
+            with ThreadPoolExecutor(max_workers=len(archs)) as executor:
+                supported = [arch for arch, ok in zip(archs, executor.map(lambda a: probe([a]), archs)) if ok]
+
+    arch_flags = [flag for arch in supported for flag in ['-arch', arch]]
 
     print(f"Discovered {compiler} arch flags: {arch_flags}")
+
+    # Don't cache failures: they may come from a fixable toolchain problem (e.g., Xcode's
+    # license not accepted) that doesn't change the compiler's path or mtime.
+    if arch_flags:
+        cache[key] = arch_flags
+        try:
+            os.makedirs(path.dirname(ARCH_PROBE_CACHE), exist_ok=True)
+            tmpfile = ARCH_PROBE_CACHE + f'.{os.getpid()}'
+            with open(tmpfile, 'w', encoding="utf-8") as f:
+                json.dump(cache, f)
+            os.replace(tmpfile, ARCH_PROBE_CACHE)
+        except OSError:
+            pass    # caching is only an optimization
+
     return arch_flags
 
 def extra_compile_args():
@@ -49,6 +120,21 @@ def make_command():
 #    return 'nmake' if sys.platform == 'win32' else 'make'  # 'nmake' isn't found on github actions' VM
     return 'make'
 
+def ccache_command():
+    """Returns the ccache (or sccache) executable to wrap compilers with, if any"""
+    if environ.get('SCALENE_DISABLE_CCACHE', '0') != '0':
+        return None
+    import shutil
+    return shutil.which('ccache') or shutil.which('sccache')
+
+def with_ccache(cmd):
+    """Returns the given compiler command wrapped with ccache, if available and not already so"""
+    ccache = ccache_command()
+    # cmd may already be wrapped, e.g. with CC="ccache gcc"
+    if ccache and cmd and path.basename(cmd[0]) not in ('ccache', 'sccache'):
+        return [ccache] + cmd
+    return cmd
+
 def dll_suffix():
     """Returns the file suffix ("extension") of a DLL"""
     if (sys.platform == 'win32'): return '.dll'
@@ -60,14 +146,47 @@ def read_file(name):
     with open(path.join(path.dirname(__file__), name), encoding="utf-8") as f:
         return f.read()
 
+def scalene_version():
+    """Returns Scalene's version, without importing the scalene package"""
+    # importing scalene.scalene_version would run scalene/__init__.py, which needs
+    # all of the runtime dependencies installed.
+    import re
+    return re.search(r"scalene_version\s*=\s*['\"]([^'\"]+)",
+                     read_file(path.join("scalene", "scalene_version.py"))).group(1)
+
+def long_description():
+    """Returns the package's long description, unless this invocation won't use it"""
+    # egg_info, dist_info, etc. write it into PKG-INFO, so only skip reading
+    # it for invocations that don't produce any metadata.
+    info_args = {'--help', '-h', '--help-commands', '--version', '-V'}
+    commands = [arg for arg in sys.argv[1:] if not arg.startswith('-')]
+    if info_args.intersection(sys.argv[1:]) or (commands and set(commands) == {'clean'}):
+        return ""
+    return read_file("README.md")
+
 import setuptools.command.egg_info
 class EggInfoCommand(setuptools.command.egg_info.egg_info):
     """Custom command to download vendor libs before creating the egg_info."""
+
+    # pip runs egg_info several times per install, so remember that vendor-deps was made
+    VENDOR_DEPS_STAMP = path.join('build', '.vendor-deps.stamp')
+
     def run(self):
-        if sys.platform != 'win32':
+        if sys.platform != 'win32' and not self.vendor_deps_are_current():
             self.spawn([make_command(), 'vendor-deps'])
+            if not self.dry_run:
+                self.mkpath(path.dirname(self.VENDOR_DEPS_STAMP))
+                with open(self.VENDOR_DEPS_STAMP, 'w'):
+                    pass
         super().run()
 
+    def vendor_deps_are_current(self):
+        """Returns whether 'make vendor-deps' ran since GNUmakefile last changed"""
+        if not all(path.exists(p) for p in [self.VENDOR_DEPS_STAMP, 'vendor/Heap-Layers',
+                                             'vendor/printf/printf.cpp']):
+            return False
+        return path.getmtime('GNUmakefile') < path.getmtime(self.VENDOR_DEPS_STAMP)
+
 # Force building platform-specific wheel to avoid the Windows wheel
 # (which doesn't include libscalene, and thus would be considered "pure")
 # being used for other platforms.
@@ -82,6 +201,13 @@ class BuildExtCommand(setuptools.command.build_ext.build_ext):
     """Custom command that runs 'make' to generate libscalene, and also does MacOS
        supported --arch flag discovery."""
 
+    def finalize_options(self):
+        super().finalize_options()
+        # Build the extensions concurrently unless told otherwise (with --parallel/-j);
+        # build_ext then compiles them from a thread pool with one worker per extension.
+        if self.parallel is None:
+            self.parallel = min(len(self.extensions or []), os.cpu_count() or 1) or None
+
     def build_extensions(self):
         arch_flags = []
         if sys.platform == 'darwin':
@@ -89,7 +215,13 @@ class BuildExtCommand(setuptools.command.build_ext.build_ext):
             # seems to be to customize a build_ext and look at its internal flags :(
             # Also, note that self.plat_name here isn't "...-universal2" even if that
             # is what we're building; that's only in bdist_wheel.plat_name.
-            arch_flags += compiler_archs(self.compiler.compiler_cxx[0])
+            if 'ARCHFLAGS' in environ:
+                # ARCHFLAGS (as set by cibuildwheel, etc.) states what to build for,
+                # so there's no need to probe.
+                import shlex
+                arch_flags += shlex.split(environ['ARCHFLAGS'])
+            else:
+                arch_flags += compiler_archs(self.compiler.compiler_cxx[0])
             for ext in self.extensions:
                 # While the flags _could_ be different between the programs used for
                 # C and C++ compilation and linking, we have no way to adapt them here,
@@ -97,11 +229,20 @@ class BuildExtCommand(setuptools.command.build_ext.build_ext):
                 ext.extra_compile_args += arch_flags
                 ext.extra_link_args += arch_flags
 
+        if self.compiler.compiler_type == 'unix':
+            # Only wrap the compile commands: ccache doesn't cache links, and distutils
+            # derives the C++ link command from compiler_cxx, linker_so and linker_exe,
+            # which must keep matching.  Newer setuptools compile C++ with compiler_so_cxx.
+            for attr in ['compiler_so', 'compiler_so_cxx']:
+                cmd = getattr(self.compiler, attr, None)
+                if cmd:
+                    self.compiler.set_executable(attr, with_ccache(cmd))
+
         super().build_extensions()
 
         # No build of DLL for Windows currently.
         if sys.platform != 'win32':
-            self.build_libscalene(arch_flags)   # XXX should we pass compiler_cxx here?
+            self.build_libscalene(arch_flags)
 
     def build_libscalene(self, arch_flags):
         scalene_temp = path.join(self.build_temp, 'scalene')
@@ -109,11 +250,27 @@ class BuildExtCommand(setuptools.command.build_ext.build_ext):
         libscalene = 'libscalene' + dll_suffix()
         self.mkpath(scalene_temp)
         self.mkpath(scalene_lib)
-        self.spawn([make_command(), 'OUTDIR=' + scalene_temp,
-                   'ARCH=' + ' '.join(arch_flags)])
+        # make skips libscalene on its own if it's up to date.  For --force, remove it
+        # rather than using 'make -B', which would also try to re-clone vendor/ dirs.
+        if self.force and not self.dry_run and path.exists(path.join(scalene_temp, libscalene)):
+            os.remove(path.join(scalene_temp, libscalene))
+        self.spawn(self.make_args(scalene_temp, arch_flags))
         self.copy_file(path.join(scalene_temp, libscalene),
                        path.join(scalene_lib, libscalene))
 
+    def make_args(self, scalene_temp, arch_flags):
+        """Returns the make command line that builds libscalene into scalene_temp"""
+        make_args = [make_command()]
+        # let the user's MAKEFLAGS (e.g., from a parent make) control parallelism, if given
+        if '-j' not in environ.get('MAKEFLAGS', ''):
+            make_args += [f'-j{os.cpu_count() or 2}']
+        if self.compiler is not None and self.compiler.compiler_type == 'unix':
+            # use the same C++ compiler as for the extensions (with any ccache wrapper);
+            # CXXFLAGS are left to GNUmakefile, as the library needs its own flags.
+            make_args += ['CXX=' + ' '.join(with_ccache(self.compiler.compiler_cxx))]
+        return make_args + ['OUTDIR=' + scalene_temp,
+                            'ARCH=' + ' '.join(arch_flags)]
+
     def copy_extensions_to_source(self):
         # self.inplace is temporarily overriden while running build_extensions,
         # so inplace copying (for pip install -e, setup.py develop) must be done here.
@@ -124,6 +281,7 @@ class BuildExtCommand(setuptools.command.build_ext.build_ext):
             scalene_lib = path.join(self.build_lib, 'scalene')
             inplace_dir = self.get_finalized_command('build_py').get_package_dir('scalene')
             libscalene = 'libscalene' + dll_suffix()
+            # copy_file preserves times and skips the copy if the target is already current
             self.copy_file(path.join(scalene_lib, libscalene),
                            path.join(inplace_dir, libscalene))
 
@@ -139,6 +297,9 @@ pywhere = Extension('scalene.pywhere',
     include_dirs=['.', 'src', 'src/include'],
     sources = ['src/source/pywhere.cpp'],
     extra_compile_args=extra_compile_args(),
+    # Not limited to the stable ABI: this walks other threads' states and frames
+    # (PyInterpreterState_ThreadHead, PyThreadState_Next, PyFrameObject and
+    # PyCodeObject fields), none of which the limited API provides.
     py_limited_api=False,
     language="c++")
 
@@ -150,10 +311,10 @@ dev_build = ('.dev' + environ['DEV_BUILD']) if 'DEV_BUILD' in environ else ''
 
 setup(
     name="scalene",
-    version=scalene_version + dev_build,
+    version=scalene_version() + dev_build,
     description="Scalene: A high-resolution, low-overhead CPU, GPU, and memory profiler for Python",
     keywords="performance memory profiler",
-    long_description=read_file("README.md"),
+    long_description=long_description(),
     long_description_content_type="text/markdown",
     url="https://github.com/plasma-umass/scalene",
     author="Emery Berger",
@@ -179,7 +340,7 @@ setup(
         "Operating System :: MacOS :: MacOS X",
         "Operating System :: Microsoft :: Windows :: Windows 10"
     ],
-    packages=find_packages(),
+    packages=["scalene"],
     cmdclass={
         'bdist_wheel': BdistWheelCommand,
         'egg_info': EggInfoCommand,